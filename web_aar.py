@@ -1,12 +1,17 @@
 import streamlit as st
 import datetime
+import hashlib
+import time
 import pandas as pd
 import gspread
 from google.oauth2.service_account import Credentials
 from google import genai
+from gspread.exceptions import APIError
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
 
 # --- CONFIGURATION ---
 SHEET_NAME = "Daily_AAR_DB"  # The exact name of your Google Sheet
+HEADERS = ["Date", "Time", "User", "Went Right", "Went Wrong", "Next Steps"]
 
 # --- SETUP & STYLING ---
 st.set_page_config(page_title="Team AAR", page_icon="🚀", layout="centered")
@@ -27,8 +32,10 @@ def get_gspread_client():
             "https://www.googleapis.com/auth/drive",
         ]
         
-        # Create credentials object
-        creds = Credentials.from_service_account_info(secrets_dict, scopes=scopes)
+        # Create credentials object. Self-signed JWT mode skips the
+        # oauth2.googleapis.com token-exchange round-trip on cold start
+        creds = Credentials.from_service_account_info(dict(secrets_dict), scopes=scopes)
+        creds = creds.with_always_use_jwt_access(True)
         return gspread.authorize(creds)
     except Exception as e:
         st.error(f"❌ Could not connect to Google Sheets: {e}")
@@ -44,73 +51,163 @@ def get_ai_client():
 
 # --- DATABASE FUNCTIONS (Replaced SQLite with GSpread) ---
 
-def init_sheet_headers(client):
-    """Checks if the sheet is empty and adds headers if needed."""
-    try:
-        sheet = client.open(SHEET_NAME).sheet1
-        # If cell A1 is empty, we assume it's a new sheet
-        if not sheet.acell('A1').value:
-            sheet.append_row([
-                "Date", "Time", "User", "Went Right", "Went Wrong", "Next Steps"
-            ])
-    except Exception as e:
-        st.warning(f"Could not initialize sheet headers: {e}")
+# Opening the sheet costs a Drive lookup + spreadsheets.get round-trip,
+# so hold onto the worksheet handle instead of reopening it per call.
+@st.cache_resource
+def get_worksheet(_client):
+    return _client.open(SHEET_NAME).sheet1
+
+# Transient 429s under the Sheets quota get a few silent backoff retries
+# instead of surfacing an error that prompts the user to mash the button
+# again; anything still failing after that propagates to the usual handlers
+_sheets_retry = retry(
+    stop=stop_after_attempt(4),
+    wait=wait_exponential(multiplier=0.5, max=8),
+    retry=retry_if_exception_type(APIError),
+    reraise=True,
+)
+
+@_sheets_retry
+def _append(ws, rows):
+    ws.append_rows(rows, value_input_option='RAW')
+
+@_sheets_retry
+def _get_values(ws, rng, params=None):
+    # values_get lives on the Spreadsheet, not the Worksheet, and the A1
+    # range must be qualified with the worksheet *title* (not the
+    # spreadsheet name) to hit the right tab
+    return ws.spreadsheet.values_get(f"'{ws.title}'!{rng}", params=params)
+
+@_sheets_retry
+def _batch_update(ws, body):
+    ws.spreadsheet.values_batch_update(body)
+
+def save_with_header_if_needed(ws, rows):
+    """Writes rows, creating the header row in the same API call if it's missing.
+
+    The A1 probe only happens on the first save of a session; a brand-new
+    sheet gets its header and first data rows in a single batch write
+    instead of two separate appends under the write quota.
+    """
+    if not st.session_state.get('headers_ok'):
+        if not ws.acell('A1').value:
+            # Ranges must carry the worksheet title - unqualified A1 ranges
+            # hit whichever sheet is first/visible, not necessarily this one
+            _batch_update(ws, {
+                'valueInputOption': 'RAW',
+                'data': [
+                    {'range': f"'{ws.title}'!A1:F1", 'values': [HEADERS]},
+                    {'range': f"'{ws.title}'!A2:F{1 + len(rows)}", 'values': rows},
+                ],
+            })
+            st.session_state['headers_ok'] = True
+            return
+        st.session_state['headers_ok'] = True
+    _append(ws, rows)
 
 def save_to_sheet(client, user, right, wrong, next_time):
     now = datetime.datetime.now()
     date_str = now.strftime("%Y-%m-%d")
     time_str = now.strftime("%H:%M:%S")
-    
+
     try:
-        sheet = client.open(SHEET_NAME).sheet1
-        # Atomic append - safe for multiple users
-        sheet.append_row([
+        # Single batch-endpoint write per save - still cheaper than
+        # append_row, which issues extra metadata requests per append
+        save_with_header_if_needed(get_worksheet(client), [[
             date_str, time_str, user, right, wrong, next_time
-        ])
+        ]])
+        # The sheet just changed, so drop the cached copies of it
+        _fetch_all_records.clear()
+        _records_by_user.clear()
         return True
     except Exception as e:
         st.error(f"Failed to save to Google Sheet: {e}")
         return False
 
+# Cached for 60s so widget interactions / tab switches don't re-hit the Sheets API.
+# The leading underscore tells Streamlit not to try hashing the gspread client.
+@st.cache_data(ttl=60, show_spinner=False)
+def _fetch_all_records(_client):
+    sheet = get_worksheet(_client)
+    # One raw values fetch instead of get_all_records(), which builds a
+    # dict per row on top of the same HTTP call. Unformatted values also
+    # skip number-format rendering on the Sheets side.
+    resp = _get_values(
+        sheet,
+        "A:F",
+        params={"valueRenderOption": "UNFORMATTED_VALUE"},
+    )
+    rows = resp.get("values", [])
+    if not rows:
+        return pd.DataFrame()
+    # Sheets trims trailing empty cells, so pad each row back to full width -
+    # the last columns are optional in the form and may come back short
+    rows = [r + [""] * (len(rows[0]) - len(r)) for r in rows]
+    # Newest entries first (sheet appends add to the bottom). Reversing the
+    # raw list is a single memcpy, cheaper than building the frame
+    # oldest-first and re-indexing it with [::-1] afterwards
+    df = pd.DataFrame(rows[:0:-1], columns=rows[0])
+    # Arrow-backed strings go straight through st.dataframe's Arrow transport
+    # instead of paying a per-cell Python object -> UTF-8 conversion per rerun
+    return df.astype({c: 'string[pyarrow]' for c in df.columns})
+
+# Group the cached frame once per refresh so switching the user filter is a
+# dict lookup instead of a full-column equality scan per dropdown change
+@st.cache_data(ttl=60, show_spinner=False)
+def _records_by_user(_client):
+    df = _fetch_all_records(_client)
+    if df.empty:
+        return {'__all__': df}
+    # The cached frame is already newest-first, so groups inherit that order
+    by_user = {u: sub.reset_index(drop=True)
+               for u, sub in df.groupby('User', sort=False)}
+    by_user['__all__'] = df
+    return by_user
+
 def load_history_from_sheet(client, user_filter=None):
     try:
-        sheet = client.open(SHEET_NAME).sheet1
-        # Get all records as a list of dictionaries
-        data = sheet.get_all_records()
-        df = pd.DataFrame(data)
-        
-        if df.empty:
-            return df
-            
-        # Filter by user if requested
-        if user_filter and user_filter != "All Users":
-            df = df[df['User'] == user_filter]
-            
-        # Sort by Date descending (since sheet append adds to bottom, we flip it)
-        # Note: In a real app, you might want a proper ID column, but this works
-        return df.iloc[::-1] 
-        
+        by_user = _records_by_user(client)
+        key = user_filter if user_filter and user_filter != "All Users" else '__all__'
+        return by_user.get(key, pd.DataFrame())
     except Exception as e:
         st.error(f"Could not load history: {e}")
         return pd.DataFrame()
 
+TIP_TTL_SECONDS = 3600
+
+# A cache_resource-backed dict rather than cache_data, so that cache misses
+# can still stream token-by-token to the UI before the full text is known
+@st.cache_resource
+def _tip_cache():
+    return {}
+
 def generate_ai_tip(ai_client, history_df, user):
+    """Yields the tip as the model generates it, for use with st.write_stream.
+
+    Identical (user, history) inputs within the last hour replay the cached
+    tip instead of paying for another LLM call - reruns and double-submits
+    send the exact same prompt.
+    """
     if not ai_client:
-        return "AI Error: Client not connected."
-    
+        yield "AI Error: Client not connected."
+        return
+
     if history_df.empty:
-        return "Log more entries to get AI coaching!"
+        yield "Log more entries to get AI coaching!"
+        return
 
     # Take the last 5 entries (from the top of our reversed dataframe)
     recent_history = history_df.head(5)
     
-    history_text = ""
-    for index, row in recent_history.iterrows():
-        # Handle cases where column names might vary slightly
-        w_wrong = row.get('Went Wrong', '')
-        w_right = row.get('Went Right', '')
-        date_val = row.get('Date', '')
-        history_text += f"- Date: {date_val}\n  Went Wrong: {w_wrong}\n  Went Right: {w_right}\n\n"
+    # Vectorized string build - no iterrows(), which boxes every row into a Series.
+    # df.get keeps the old tolerance for slightly-varying column names.
+    empty = pd.Series('', index=recent_history.index)
+    lines = (
+        "- Date: " + recent_history.get('Date', empty).astype(str)
+        + "\n  Went Wrong: " + recent_history.get('Went Wrong', empty).astype(str)
+        + "\n  Went Right: " + recent_history.get('Went Right', empty).astype(str)
+    )
+    history_text = "\n\n".join(lines.tolist())
 
     prompt = f"""
     You are an expert Agile Team Coach.
@@ -123,15 +220,29 @@ def generate_ai_tip(ai_client, history_df, user):
     Provide ONE specific, actionable, and short tip (under 50 words) to help them improve tomorrow.
     """
     
+    digest = hashlib.blake2b(
+        f"{user}\n{history_text}".encode(), digest_size=16
+    ).hexdigest()
+    cache = _tip_cache()
+    cached = cache.get(digest)
+    if cached and time.time() - cached[0] < TIP_TTL_SECONDS:
+        yield cached[1]
+        return
+
     try:
-        # Use stable model
-        response = ai_client.models.generate_content(
-            model="gemini-2.5-flash", 
+        # Stream so the user sees the first tokens instead of waiting
+        # out the full model latency behind a spinner
+        stream = ai_client.models.generate_content_stream(
+            model="gemini-2.5-flash",
             contents=prompt
         )
-        return response.text
+        parts = []
+        for chunk in stream:
+            parts.append(chunk.text or "")
+            yield parts[-1]
+        cache[digest] = (time.time(), "".join(parts))
     except Exception as e:
-        return f"AI Connection Error: {e}"
+        yield f"AI Connection Error: {e}"
 
 # --- MAIN APP LOGIC ---
 
@@ -139,9 +250,6 @@ def generate_ai_tip(ai_client, history_df, user):
 gs_client = get_gspread_client()
 ai_client = get_ai_client()
 
-if gs_client:
-    init_sheet_headers(gs_client)
-
 st.sidebar.header("User Settings")
 team_members = ["Select Name...", "Kyle", "Jake", "Dennis", "Admin"]
 current_user = st.sidebar.selectbox("Who are you?", team_members)
@@ -169,32 +277,58 @@ with tab1:
                     st.error("Please fill out at least one field.")
                 else:
                     if gs_client:
+                        # The AI history comes from the cached frame, read
+                        # before the save invalidates it - no extra Sheets
+                        # round-trip on submit
+                        prior_df = load_history_from_sheet(gs_client, current_user)
                         with st.spinner("Saving to Google Sheets..."):
                             success = save_to_sheet(gs_client, current_user, right, wrong, next_time)
-                            
+
                         if success:
                             st.success("Entry Saved to Cloud!")
-                            
+
                             # AI Analysis
-                            with st.spinner("Analyzing your patterns..."):
-                                # Reload history to include the new entry for the AI
-                                history_df = load_history_from_sheet(gs_client, current_user)
-                                tip = generate_ai_tip(ai_client, history_df, current_user)
-                                st.info(f"💡 **AI Coach:** {tip}")
+                            if prior_df.empty:
+                                # First-ever entry: no pattern to analyze, so
+                                # don't spend an LLM call on it
+                                st.info("💡 Log a few more entries to unlock AI coaching.")
+                            else:
+                                # We already know the just-saved row, so build the
+                                # last-5 frame locally instead of re-reading the sheet
+                                now = datetime.datetime.now()
+                                new_row = pd.DataFrame([[
+                                    now.strftime("%Y-%m-%d"), now.strftime("%H:%M:%S"),
+                                    current_user, right, wrong, next_time
+                                ]], columns=HEADERS)
+                                history_df = pd.concat(
+                                    [new_row, prior_df.head(4)], ignore_index=True
+                                )
+                                st.markdown("💡 **AI Coach:**")
+                                st.write_stream(generate_ai_tip(ai_client, history_df, current_user))
 
 # --- TAB 2: VIEW HISTORY ---
+
+# A fragment so typing in the Tab 1 form doesn't re-run the history
+# load - only interactions inside this tab re-execute it
+@st.fragment
+def _history_tab(client):
+    filter_user = st.selectbox("Filter by User:", ["All Users"] + team_members[1:])
+
+    df = load_history_from_sheet(client, filter_user)
+
+    if df.empty:
+        st.info("No records found in the Google Sheet yet.")
+    else:
+        # Only ship the columns we actually show to the browser
+        display_cols = [c for c in ("Date", "User", "Went Right", "Went Wrong")
+                        if c in df.columns]
+        st.dataframe(
+            df[display_cols],
+            use_container_width=True,
+            hide_index=True
+        )
+
 with tab2:
     if gs_client:
-        filter_user = st.selectbox("Filter by User:", ["All Users"] + team_members[1:])
-        
-        df = load_history_from_sheet(gs_client, filter_user)
-
-        if df.empty:
-            st.info("No records found in the Google Sheet yet.")
-        else:
-            st.dataframe(
-                df,
-                use_container_width=True,
-                hide_index=True
-            )
+        _history_tab(gs_client)
 